@@ -3,6 +3,7 @@ from azure.search.documents import SearchClient
 import os
 import requests
 import json
+from chainlit.logger import logger
 
 search_endpoint = os.getenv("ai_search_url")
 search_key = os.getenv("ai_search_key")
@@ -89,7 +90,7 @@ tools_list = [
 ]
 
 def perform_search_based_qna(query):
-    print("calling search to get context for the response ....")
+    logger.debug("calling search to get context for the response ....")
     credential = AzureKeyCredential(search_key)
     client = SearchClient(
         endpoint=search_endpoint,
@@ -105,9 +106,10 @@ def perform_search_based_qna(query):
     counter = 0
     results = list(response)
     for result in results:
-        print("--------result------>", result)
-        print(
-            f"search result from document:{result['metadata_storage_name']}, and content: {result['content']}  "
+        logger.debug(
+            "search result from document:%s, and content: %s",
+            result["metadata_storage_name"],
+            result["content"],
         )
         response_docs += (
             " --- Document context start ---"
@@ -117,7 +119,7 @@ def perform_search_based_qna(query):
         counter += 1
         if counter == 2:
             break
-    print("***********  calling LLM now ....***************")
+    logger.debug("calling LLM now ....")
     return response_docs
 
 
@@ -132,7 +134,7 @@ def create_delivery_order(order_id: str, destination: str) -> str:
     """
 
     api_url = logic_app_url_shipment_orders
-    print("creating shipment order using Logic app.................")
+    logger.debug("creating shipment order using Logic app.................")
     # make a HTTP POST API call with json payload
     response = requests.post(
         api_url,
@@ -140,7 +142,7 @@ def create_delivery_order(order_id: str, destination: str) -> str:
         headers={"Content-Type": "application/json"},
     )
 
-    print("response from shipment order creation", response.text)
+    logger.debug("response from shipment order creation %s", response.text)
     return json.dumps(response.text)
 
 
@@ -154,34 +156,31 @@ def perform_call_log_analysis(call_log: str) -> str:
     """
 
     api_url = logic_app_url_call_log_analysis
-    print("analyzing call log using Logic app.................")
-    print(f"DEBUG: Received call_log parameter: {call_log}")
-    print(f"DEBUG: call_log type: {type(call_log)}")
-    print(f"DEBUG: api_url: {api_url}")
+    logger.debug("analyzing call log using Logic app.................")
+    logger.debug("Received call_log parameter: %s", call_log)
     
     # Parse the call_log as JSON before sending to Logic App
     try:
-        print("DEBUG: Attempting to parse call_log as JSON...")
         call_log_json = json.loads(call_log)
-        print(f"DEBUG: Successfully parsed JSON: {call_log_json}")
     except json.JSONDecodeError as e:
-        print(f"Error parsing call_log as JSON: {e}")
-        print(f"DEBUG: Failed to parse. Raw call_log: {repr(call_log)}")
+        logger.error("Error parsing call_log as JSON: %s. Raw call_log: %r", e, call_log)
         return json.dumps({"error": "Invalid JSON format in call_log"})
     
     # make a HTTP POST API call with json payload
     try:
-        print("DEBUG: Making POST request to Logic App...")
         response = requests.post(
             api_url,
             json={"call_logs": call_log_json},
             headers={"Content-Type": "application/json"},
         )
-        print(f"DEBUG: Response status code: {response.status_code}")
-        print("response from call log analysis", response.text)
+        logger.debug(
+            "response from call log analysis (status %s): %s",
+            response.status_code,
+            response.text,
+        )
         return json.dumps(response.text)
     except Exception as e:
-        print(f"ERROR: Exception during API call: {e}")
+        logger.error("Exception during API call: %s", e)
         return json.dumps({"error": f"API call failed: {str(e)}"})
 
 
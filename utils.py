@@ -1,5 +1,18 @@
 import numpy as np
 import base64
+import pybase64
+import chainlit as cl
+from chainlit.logger import logger
+from azure.identity import DefaultAzureCredential
+from uuid import UUID, uuid4
+from collections import deque
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Optional
+import asyncio
+import itertools
+import os
+import time
 
 def float_to_16bit_pcm(float32_array):
     """
@@ -7,8 +20,10 @@ def float_to_16bit_pcm(float32_array):
     :param float32_array: numpy array of float32
     :return: numpy array of int16
     """
-    int16_array = np.clip(float32_array, -1, 1) * 32767
-    return int16_array.astype(np.int16)
+    # the clipped copy is scaled in place, rather than allocating a second float array for the product
+    scaled = np.clip(float32_array, -1, 1)
+    np.multiply(scaled, 32767, out=scaled)
+    return scaled.astype(np.int16)
 
 
 def base64_to_array_buffer(base64_string):
@@ -21,20 +36,57 @@ def base64_to_array_buffer(base64_string):
     return np.frombuffer(binary_data, dtype=np.uint8)
 
 
+def base64_to_bytes(base64_string):
+    """
+    Converts a base64 string to bytes, without going through a numpy array.
+    pybase64 is used for its vectorized decoder.
+    :param base64_string: base64 encoded string
+    :return: the decoded bytes
+    """
+    return pybase64.b64decode(base64_string, validate=False)
+
+
+AUDIO_DELTA_PREFIX = '{"type":"response.audio.delta"'
+AUDIO_DELTA_KEY = '"delta":"'
+
+
+def peek_audio_delta(message):
+    """
+    Extracts the base64 audio of a response.audio.delta event from the raw message, without parsing the JSON.
+    Only messages that start with the event type, and whose audio needs no unescaping, are handled this way.
+    :param message: raw text of a message received from the Voice Live API
+    :return: the base64 encoded audio, or None if the message has to be parsed as usual
+    """
+    if not isinstance(message, str) or not message.startswith(AUDIO_DELTA_PREFIX):
+        return None
+    start = message.find(AUDIO_DELTA_KEY)
+    if start < 0:
+        return None
+    start += len(AUDIO_DELTA_KEY)
+    end = message.find('"', start)
+    if end < 0:
+        return None
+    delta = message[start:end]
+    # base64 never needs escaping in JSON, but the server is free to escape characters like '/' anyway
+    if "\\" in delta:
+        return None
+    return delta
+
+
 def array_buffer_to_base64(array_buffer):
     """
-    Converts a numpy array buffer to a base64 string.
-    :param array_buffer: numpy array
+    Converts a numpy array buffer, or any bytes-like object, to a base64 string.
+    The data is encoded in place, without first being copied into a new bytes object.
+    :param array_buffer: numpy array, bytes, bytearray or memoryview
     :return: base64 encoded string
     """
-    if array_buffer.dtype == np.float32:
-        array_buffer = float_to_16bit_pcm(array_buffer)
-    elif array_buffer.dtype == np.int16:
-        array_buffer = array_buffer.tobytes()
-    else:
-        array_buffer = array_buffer.tobytes()
+    if isinstance(array_buffer, np.ndarray):
+        if array_buffer.dtype == np.float32:
+            array_buffer = float_to_16bit_pcm(array_buffer)
+        array_buffer = np.ascontiguousarray(array_buffer)
 
-    return base64.b64encode(array_buffer).decode("utf-8")
+    # pybase64 uses a vectorized encoder, and returns the str directly
+    return pybase64.b64encode_as_string(array_buffer)
 
 
 def merge_int16_arrays(left, right):
@@ -53,3 +105,561 @@ def merge_int16_arrays(left, right):
         return np.concatenate((left, right))
     else:
         raise ValueError("Both items must be numpy arrays of int16")
+
+
+def pcm16_level(data):
+    """
+    Computes the mean absolute amplitude of PCM16 audio. The samples are read in place from the buffer,
+    and widened into a single int32 copy to take their absolute value.
+    :param data: bytes-like object of little-endian int16 samples
+    :return: mean absolute amplitude, on a scale of 0 to 32768
+    """
+    samples = np.frombuffer(data, dtype="<i2")
+    if samples.size == 0:
+        return 0.0
+    # widened before taking the absolute value, as abs(-32768) does not fit in an int16
+    return float(np.abs(samples.astype(np.int32)).mean())
+
+
+class AudioRingBuffer:
+    """
+    Fixed-capacity ring buffer for PCM audio bytes.
+    The storage is allocated once; when the buffer is full, the oldest audio is overwritten
+    rather than the buffer being grown.
+    """
+
+    def __init__(self, capacity=65536):
+        self._buffer = bytearray(capacity)
+        # preallocated scratch space, used to present wrapped-around contents as one contiguous block
+        self._linear = bytearray(capacity)
+        self._capacity = capacity
+        self._head = 0
+        self._size = 0
+        # number of bytes overwritten before they could be read
+        self.dropped = 0
+
+    def __len__(self):
+        return self._size
+
+    def write(self, data):
+        """
+        Appends the audio bytes to the buffer, overwriting the oldest audio if there is not enough room.
+        :param data: bytes-like object
+        """
+        data = memoryview(data).cast("B")
+        n = len(data)
+        if n >= self._capacity:
+            # only the most recent audio that fits is kept
+            self.dropped += self._size + n - self._capacity
+            self._buffer[:] = data[n - self._capacity :]
+            self._head = 0
+            self._size = self._capacity
+            return
+        overflow = self._size + n - self._capacity
+        if overflow > 0:
+            self._head = (self._head + overflow) % self._capacity
+            self._size -= overflow
+            self.dropped += overflow
+        tail = (self._head + self._size) % self._capacity
+        first = min(n, self._capacity - tail)
+        self._buffer[tail : tail + first] = data[:first]
+        if first < n:
+            self._buffer[: n - first] = data[first:]
+        self._size += n
+
+    def read_all(self):
+        """
+        Empties the buffer, returning its contents as a single contiguous view, without allocating.
+        The view refers to the buffer's own storage, hence it must be consumed before the next write.
+        :return: memoryview of the buffered bytes
+        """
+        head, size = self._head, self._size
+        self._head = 0
+        self._size = 0
+        if head + size <= self._capacity:
+            return memoryview(self._buffer)[head : head + size]
+        # the wrapped-around halves are copied through views, rather than through temporary slices of the storage
+        buffer = memoryview(self._buffer)
+        first = self._capacity - head
+        self._linear[:first] = buffer[head:]
+        self._linear[first:size] = buffer[: size - first]
+        return memoryview(self._linear)[:size]
+
+
+# The connection to the Voice Live API is kept alive with websocket pings at this interval (in seconds), below
+# the idle timeouts of common NAT devices and proxies, so that it is not dropped while the user is silent
+KEEPALIVE_PING_INTERVAL = 15
+KEEPALIVE_PING_TIMEOUT = 20
+
+# The access token is shared by all sessions of the process, and only fetched again shortly before it expires,
+# since acquiring one may probe several credential sources
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_SCOPES = "https://ai.azure.com/.default"
+_access_token = None
+# the credential is created on first use and shared as well, so that its provider chain is set up only once
+_credential = None
+
+
+def get_credential() -> DefaultAzureCredential:
+    global _credential
+    if _credential is None:
+        _credential = DefaultAzureCredential()
+    return _credential
+
+
+def get_access_token() -> str:
+    """
+    Gets an access token for the Voice Live API, reusing the cached one until it is about to expire.
+    :return: the bearer token
+    """
+    global _access_token
+    if _access_token is None or _access_token.expires_on - time.time() <= TOKEN_REFRESH_MARGIN:
+        _access_token = get_credential().get_token(TOKEN_SCOPES)
+    return _access_token.token
+
+
+# Event ids are made of a per-process prefix and a counter, rather than derived from the current time,
+# which costs a clock read and formatting per event and repeats within the same millisecond
+_event_id_prefix = uuid4().hex[:8]
+_event_id_counter = itertools.count()
+
+
+def new_event_id(prefix):
+    """
+    Generates a client event id, unique within this process.
+    :param prefix: prefix of the id, e.g. "evt_"
+    :return: the event id
+    """
+    return f"{prefix}{_event_id_prefix}-{next(_event_id_counter)}"
+
+
+# Browser audio frames are coalesced in a ring buffer before being forwarded to the Voice Live API,
+# so that each websocket send carries roughly 80ms of audio instead of a single frame.
+# The flush interval bounds the latency added by the batching, counted from the first buffered frame.
+# Should the sends fall behind, the oldest audio is overwritten once the buffer is full.
+AUDIO_INPUT_FLUSH_BYTES = 2560
+AUDIO_INPUT_FLUSH_INTERVAL = 0.04
+AUDIO_INPUT_BUFFER_SIZE = 65536
+
+# Optionally, near-silent input audio is not sent to the Voice Live API between utterances.
+# Silence keeps being sent for a hangover period after the user stops speaking, longer than the
+# server's end of speech detection needs, and the most recent skipped audio is sent ahead of the next
+# utterance, so that the server VAD still sees its usual prefix padding.
+# The preroll holds 300ms of 24kHz PCM16 audio, the larger prefix_padding_ms of the two session configs
+AUDIO_INPUT_SKIP_SILENCE = os.getenv("AUDIO_INPUT_SKIP_SILENCE", "false").lower() == "true"
+AUDIO_INPUT_SILENCE_LEVEL = 200
+AUDIO_INPUT_SILENCE_HANGOVER = 3.0
+AUDIO_INPUT_PREROLL_SIZE = 14400
+
+# Updates to the response transcript in the chat window are coalesced into one per interval,
+# since the deltas arrive far faster than they can be perceived
+TRANSCRIPT_UPDATE_INTERVAL = 0.05
+
+# Response audio is handed over to a dedicated sender task through a bounded deque, so that
+# sending it to the UI never holds up the processing of further events from the Voice Live API.
+# Once the deque is full, appending a chunk drops the oldest one rather than letting the playback latency grow
+AUDIO_OUTPUT_QUEUE_SIZE = 64
+
+# Errors forwarding browser audio are reported in the chat at most once per interval,
+# so that a flapping connection does not flood the chat window with a message per frame
+AUDIO_INPUT_ERROR_REPORT_INTERVAL = 5.0
+
+# Audio track ids only need to be unique within this process, so they are derived from a
+# per-process prefix and a counter instead of generating a new uuid on every interrupt
+_track_id_prefix = uuid4().hex[:8]
+_track_id_counter = itertools.count()
+
+
+def new_track_id() -> str:
+    return f"{_track_id_prefix}-{next(_track_id_counter)}"
+
+
+# Message ids have to be proper uuids. They are generated in batches from a single read of
+# random bytes, rather than reading from the OS for every id on the interrupt path
+MESSAGE_ID_BATCH_SIZE = 64
+_message_id_pool = deque()
+
+
+def new_message_id() -> str:
+    if not _message_id_pool:
+        raw = os.urandom(16 * MESSAGE_ID_BATCH_SIZE)
+        _message_id_pool.extend(
+            str(UUID(bytes=raw[i : i + 16], version=4))
+            for i in range(0, len(raw), 16)
+        )
+    return _message_id_pool.popleft()
+
+
+@dataclass(slots=True)
+class TranscriptRef:
+    """Tracks the chat message a transcript is written to, along with the deltas not yet sent to it."""
+
+    item_id: Optional[str] = None
+    parts: list = field(default_factory=list)
+    last_update: float = 0.0
+    pending_update: Optional[asyncio.Task] = None
+    message: Optional[cl.Message] = None
+
+
+@dataclass(slots=True)
+class SessionState:
+    """State of a voice chat session, shared by the Voice Live event handlers and the audio tasks.
+    It is created once per session and passed to the handlers, rather than looked up in the user session
+    for every event."""
+
+    # the current audio track id only changes when the user interrupts
+    track_id: str = field(default_factory=new_track_id)
+    transcript: TranscriptRef = field(default_factory=TranscriptRef)
+    # the placeholder message awaiting the transcript of the user's speech, if one was sent
+    user_transcript_message: Optional[cl.Message] = None
+    audio_input_buffer: AudioRingBuffer = field(
+        default_factory=lambda: AudioRingBuffer(AUDIO_INPUT_BUFFER_SIZE)
+    )
+    # set when the buffered input audio is due to be sent
+    audio_input_ready: asyncio.Event = field(default_factory=asyncio.Event)
+    # the most recent input audio held back as silence, and when the user was last heard
+    audio_input_preroll: AudioRingBuffer = field(
+        default_factory=lambda: AudioRingBuffer(AUDIO_INPUT_PREROLL_SIZE)
+    )
+    last_voiced_input: float = float("-inf")
+    audio_output_queue: deque = field(
+        default_factory=lambda: deque(maxlen=AUDIO_OUTPUT_QUEUE_SIZE)
+    )
+    # set when response audio has been queued for the sender task
+    audio_output_ready: asyncio.Event = field(default_factory=asyncio.Event)
+    # response audio is only queued while voice mode is on; responses to typed messages
+    # before that are only shown as text, rather than played back once the mic is activated
+    audio_output_enabled: bool = False
+    last_audio_input_error: float = float("-inf")
+
+
+def handle_conversation_updated(state: SessionState, event):
+    """Used to play the response audio chunks as they are received from the server.
+    The chunks are queued for the audio sender task, which relays them to the UI. This is a plain function,
+    so that the client calls it inline for every audio delta instead of spawning a task"""
+    _audio = event.get("audio")
+    if _audio and state.audio_output_enabled:
+        state.audio_output_queue.append((state.track_id, _audio))
+        state.audio_output_ready.set()
+
+
+def discard_queued_audio(state: SessionState):
+    """Drops the response audio still waiting to be relayed to the UI. Once the user interrupts,
+    it belongs to a response that is no longer wanted, and would otherwise be played ahead of the new one"""
+    state.audio_output_queue.clear()
+
+
+async def handle_conversation_interrupt(state: SessionState, event):
+    """This applies when the user interrupts during an audio playback.
+    This stops the audio playback to listen to what the user has to say"""
+    logger.debug("🔄 Conversation interrupted - stopping audio playback")
+    state.track_id = new_track_id()
+    discard_queued_audio(state)
+    # stopping the playback, completing the interrupted response transcript and creating the
+    # placeholder for the user transcript are independent UI updates, hence sent concurrently
+    updates = [
+        cl.context.emitter.send_audio_interrupt(),
+        flush_pending_response_transcript(state.transcript),
+    ]
+    # a placeholder that has not received its transcript yet is still empty, and is reused
+    # rather than sending another empty message
+    if state.user_transcript_message is None:
+        state.user_transcript_message = cl.Message(
+            content="",
+            author="user",
+            type="user_message",
+            id=new_message_id(),
+        )
+        updates.append(state.user_transcript_message.send())
+    results = await asyncio.gather(*updates, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("❌ Error handling conversation interrupt: %s", result)
+
+
+async def handle_conversation_message_interrupted(state: SessionState, event):
+    """This applies when the user interrupts with a chat input.
+    This stops the audio playback to listen to what the user has to say"""
+    logger.debug("🔄 Conversation interrupted due to user chat message - stopping audio playback")
+    state.track_id = new_track_id()
+    discard_queued_audio(state)
+
+
+async def update_response_transcript(transcript_ref: TranscriptRef):
+    """Streams the response transcript deltas accumulated since the last update to the chat window.
+    Only the new text is sent over the wire, rather than the whole transcript every time"""
+    transcript_ref.last_update = time.monotonic()
+    token = "".join(transcript_ref.parts)
+    transcript_ref.parts.clear()
+    if token:
+        await transcript_ref.message.stream_token(token)
+
+
+async def deferred_response_transcript_update(transcript_ref: TranscriptRef, delay):
+    """Updates the response transcript once the current update interval has elapsed."""
+    await asyncio.sleep(delay)
+    transcript_ref.pending_update = None
+    await update_response_transcript(transcript_ref)
+
+
+async def flush_pending_response_transcript(transcript_ref: TranscriptRef):
+    """Immediately applies a deferred update of the response transcript, if one is scheduled."""
+    pending_update = transcript_ref.pending_update
+    if pending_update:
+        pending_update.cancel()
+        transcript_ref.pending_update = None
+        await update_response_transcript(transcript_ref)
+
+
+async def complete_response_transcript(transcript_ref: TranscriptRef):
+    """Streams what is left of the response transcript, and ends the streaming of its message."""
+    if transcript_ref.message is None:
+        return
+    await flush_pending_response_transcript(transcript_ref)
+    await transcript_ref.message.send()
+
+
+async def handle_response_audio_transcript_updated(state: SessionState, event):
+    """Used to populate the chat context with transcription once an audio transcript of the response is done."""
+    delta = event.get("transcript")
+    if not delta:
+        return
+    item_id = event.get("item_id")
+    transcript_ref = state.transcript
+
+    # identify if there is a new message or an update to an existing message (i.e. delta to an existing transcript)
+    if transcript_ref.item_id == item_id:
+        # the deltas are accumulated in a list and joined only when the message is updated
+        transcript_ref.parts.append(delta)
+        # appending the delta transcript from audio to the previous transcript.
+        # The chat window is updated at most once per interval; deltas arriving in between
+        # are picked up by a single deferred update
+        elapsed = time.monotonic() - transcript_ref.last_update
+        if elapsed >= TRANSCRIPT_UPDATE_INTERVAL:
+            if transcript_ref.pending_update:
+                transcript_ref.pending_update.cancel()
+                transcript_ref.pending_update = None
+            await update_response_transcript(transcript_ref)
+        elif transcript_ref.pending_update is None:
+            transcript_ref.pending_update = asyncio.create_task(
+                deferred_response_transcript_update(
+                    transcript_ref, TRANSCRIPT_UPDATE_INTERVAL - elapsed
+                )
+            )
+    else:
+        previous_transcript_ref = transcript_ref
+        transcript_ref = TranscriptRef(
+            item_id=item_id,
+            last_update=time.monotonic(),
+            message=cl.Message(
+                content="",
+                author="assistant",
+                type="assistant_message",
+                id=item_id,
+            ),
+        )
+        state.transcript = transcript_ref
+
+        # make sure the previous response shows its complete transcript, and start streaming
+        # the new response transcript in the chat interface. The two messages are
+        # independent of each other, hence the UI updates are sent concurrently
+        await asyncio.gather(
+            complete_response_transcript(previous_transcript_ref),
+            transcript_ref.message.stream_token(delta),
+        )
+
+
+async def handle_response_done(state: SessionState, event):
+    """Completes the response transcript message once the response is done, rather than leaving its
+    tail end to the update interval and the message streaming until the next response starts."""
+    transcript_ref = state.transcript
+    # the completed message is not sent again when the next response starts
+    state.transcript = TranscriptRef()
+    await complete_response_transcript(transcript_ref)
+
+
+async def handle_user_input_transcript_done(state: SessionState, event):
+    """Used to populate the chat context with transcription once an audio transcript of user input is completed.
+    Creates the user message directly with the transcript content.
+    """
+    transcript = event.get("transcript")
+    message = state.user_transcript_message
+    # the placeholder is consumed by this transcript; the next one is created on the next interrupt
+    state.user_transcript_message = None
+    if message is None:
+        # no placeholder message is pending for this transcript, hence create the message
+        await cl.Message(content=transcript, author="user", type="user_message").send()
+        return
+
+    # A placeholder message was created for the user input transcript earlier. updating the message with the actual transcript,
+    # through the same message object that was sent as the placeholder
+    message.content = transcript
+    await message.update()
+
+
+async def flush_input_audio(openai_realtime, state: SessionState):
+    """Sends the audio frames buffered so far to the Voice Live API as a single append event."""
+    buffer = state.audio_input_buffer
+    if buffer.dropped:
+        # the ring buffer overwrote audio that could not be sent in time; report it, as the server
+        # will have missed part of what the user said
+        logger.warning(
+            "⚠️ Dropped %d bytes of input audio, as sending to the Voice Live API fell behind",
+            buffer.dropped,
+        )
+        buffer.dropped = 0
+    if buffer and openai_realtime and openai_realtime.is_connected():
+        # the view into the ring buffer is base64 encoded before the send yields to other tasks,
+        # so frames arriving during the send cannot overwrite it
+        await openai_realtime.append_input_audio(buffer.read_all())
+
+
+def skip_silent_input_audio(state: SessionState, data) -> bool:
+    """Tells whether an input audio frame is held back as silence. When the user is heard again,
+    the held back audio is buffered for sending ahead of the frame."""
+    now = time.monotonic()
+    if pcm16_level(data) >= AUDIO_INPUT_SILENCE_LEVEL:
+        if state.audio_input_preroll:
+            state.audio_input_buffer.write(state.audio_input_preroll.read_all())
+        state.last_voiced_input = now
+        return False
+    if now - state.last_voiced_input <= AUDIO_INPUT_SILENCE_HANGOVER:
+        return False
+    state.audio_input_preroll.write(data)
+    return True
+
+
+async def report_audio_input_error(state: SessionState, e: Exception):
+    """Reports an error forwarding the input audio in the chat, unless one was reported within the interval."""
+    now = time.monotonic()
+    if now - state.last_audio_input_error >= AUDIO_INPUT_ERROR_REPORT_INTERVAL:
+        state.last_audio_input_error = now
+        await cl.ErrorMessage(
+            content=f"Failed to send audio chunk to Voice Live API: {e}"
+        ).send()
+
+
+async def input_audio_flusher():
+    """Sends the buffered audio whenever it is due: once enough audio has accumulated, or once the
+    flush interval has elapsed since the first frame was buffered, so that the tail end of an utterance is not held back."""
+    openai_realtime = cl.user_session.get("openai_realtime")
+    state: SessionState = cl.user_session.get("session_state")
+    while True:
+        await state.audio_input_ready.wait()
+        state.audio_input_ready.clear()
+        try:
+            await flush_input_audio(openai_realtime, state)
+        except Exception as e:
+            logger.error("❌ Failed to flush audio to Voice Live API: %s", e)
+            try:
+                await report_audio_input_error(state, e)
+            except Exception:
+                logger.exception("❌ Failed to report audio error")
+
+
+async def output_audio_sender():
+    """Relays the response audio chunks queued by the client event handlers to the UI for playback."""
+    state: SessionState = cl.user_session.get("session_state")
+    audio_output_queue = state.audio_output_queue
+    while True:
+        await state.audio_output_ready.wait()
+        state.audio_output_ready.clear()
+        # everything queued up to now is sent before waiting again. Chunks that queued up for the same
+        # track while the previous send was in progress are coalesced into a single send
+        while audio_output_queue:
+            track, data = audio_output_queue.popleft()
+            if audio_output_queue and audio_output_queue[0][0] == track:
+                parts = [data]
+                while audio_output_queue and audio_output_queue[0][0] == track:
+                    parts.append(audio_output_queue.popleft()[1])
+                data = b"".join(parts)
+            try:
+                await cl.context.emitter.send_audio_chunk(
+                    cl.OutputAudioChunk(mimeType="pcm16", data=data, track=track)
+                )
+            except Exception as e:
+                logger.error("❌ Error sending audio chunk: %s", e)
+
+
+async def await_preconnect():
+    """Waits for the connection started in on_chat_start, if it is still pending. A failed preconnect
+    is only logged, so that the caller can fall back to connecting on its own."""
+    preconnect = cl.user_session.get("preconnect")
+    if preconnect:
+        cl.user_session.set("preconnect", None)
+        try:
+            await preconnect
+        except Exception as e:
+            logger.warning("⚠️ Preconnect to Voice Live API failed: %s", e)
+
+
+async def handle_connection_lost(state: SessionState, event):
+    """Tells the user once that the connection to the Voice Live API was lost, rather than leaving them
+    talking into a microphone whose audio no longer goes anywhere."""
+    logger.warning("⚠️ Connection to Voice Live API lost")
+    discard_queued_audio(state)
+    await cl.ErrorMessage(
+        content="The connection to Voice Live API was lost. Turn the microphone off and on again, or send a message, to reconnect."
+    ).send()
+
+
+def session_event_handlers(state: SessionState) -> dict:
+    """Returns the Voice Live client event handlers of a session. They are bound to the session state,
+    rather than defined as closures for every session."""
+    return {
+        "conversation.updated": partial(handle_conversation_updated, state),
+        "conversation.interrupted": partial(handle_conversation_interrupt, state),
+        "conversation.text.delta": partial(handle_response_audio_transcript_updated, state),
+        "conversation.response.done": partial(handle_response_done, state),
+        "conversation.input.text.done": partial(handle_user_input_transcript_done, state),
+        "conversation.message.interrupted": partial(
+            handle_conversation_message_interrupted, state
+        ),
+        "connection.lost": partial(handle_connection_lost, state),
+    }
+
+
+def buffer_input_audio(state: SessionState, data):
+    """Buffers an input audio frame from the browser, and signals the flusher task once the batch is due."""
+    buffer = state.audio_input_buffer
+    was_empty = not buffer
+    if AUDIO_INPUT_SKIP_SILENCE and skip_silent_input_audio(state, data):
+        return
+    buffer.write(data)
+    if len(buffer) >= AUDIO_INPUT_FLUSH_BYTES:
+        state.audio_input_ready.set()
+    elif was_empty:
+        # the first frame of a batch sets the deadline by which the batch is sent
+        asyncio.get_running_loop().call_later(
+            AUDIO_INPUT_FLUSH_INTERVAL, state.audio_input_ready.set
+        )
+
+
+AUDIO_TASKS = {
+    "audio_input_flusher": input_audio_flusher,
+    "audio_output_sender": output_audio_sender,
+}
+
+
+def start_audio_tasks(state: SessionState):
+    """Starts the audio tasks of a voice session, and enables the playback of response audio."""
+    discard_queued_audio(state)
+    state.audio_output_enabled = True
+    # a task that has ended on an unexpected error is replaced, rather than left in the user session
+    for task_key, task_func in AUDIO_TASKS.items():
+        task = cl.user_session.get(task_key)
+        if not task or task.done():
+            cl.user_session.set(task_key, asyncio.create_task(task_func()))
+
+
+def stop_audio_tasks(state: Optional[SessionState]):
+    """Cancels the pending preconnect and the audio tasks of a voice session."""
+    for task_key in ("preconnect", *AUDIO_TASKS):
+        task = cl.user_session.get(task_key)
+        if task:
+            task.cancel()
+            cl.user_session.set(task_key, None)
+    if state:
+        # audio left in the queue would otherwise be played the next time voice mode is activated
+        state.audio_output_enabled = False
+        discard_queued_audio(state)
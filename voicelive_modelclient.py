@@ -27,16 +27,21 @@ Author: Microsoft Innovation Hub India
 Version: 1.0
 """
 
-from utils import array_buffer_to_base64, base64_to_array_buffer
-import traceback
+from utils import (
+    KEEPALIVE_PING_INTERVAL,
+    KEEPALIVE_PING_TIMEOUT,
+    array_buffer_to_base64,
+    base64_to_bytes,
+    get_access_token,
+    new_event_id,
+    peek_audio_delta,
+)
 import inspect
-import numpy as np
 from chainlit.logger import logger
-import json
+import orjson
 import datetime
+import logging
 import asyncio
-from collections import defaultdict
-from azure.identity import DefaultAzureCredential
 import uuid
 import os
 from dotenv import load_dotenv
@@ -106,6 +111,7 @@ Important confirmation requirements:
 **Remember that your persona is that of a woman. When you speak to teh customer in Hini, mind your gender when you respond**
 """
 
+
 class VoiceLiveModelClient:
     """
     Azure Voice Live API Client for Direct GPT-Realtime Model Integration
@@ -144,7 +150,11 @@ class VoiceLiveModelClient:
 
     def __init__(self):
         self.ws = None
-        self.event_handlers = defaultdict(list)
+        # connection status is kept as a plain attribute, as it is checked for every audio chunk
+        self.connected = False
+        self._connect_lock = asyncio.Lock()
+        # one handler per event name, along with whether it is a coroutine function
+        self.event_handlers = {}
         self._speech_active = False
         self._pending_interrupt_task = None
         self.interrupt_debounce_ms = 450
@@ -169,33 +179,57 @@ class VoiceLiveModelClient:
             "input_audio_transcription": {"model": "whisper-1"},
         }
         self.response_config = {"modalities": ["text", "audio"]}
+        # handlers for the events received from the Voice Live API, by event type
+        self.server_event_handlers = {
+            "response.audio.delta": self._handle_response_audio_delta,
+            "response.audio.done": self._handle_response_audio_done,
+            "input_audio_buffer.committed": self._handle_input_audio_buffer_committed,
+            "input_audio_buffer.speech_started": self._handle_speech_started,
+            "input_audio_buffer.speech_stopped": self._handle_speech_stopped,
+            "response.audio_transcript.delta": self._handle_response_audio_transcript_delta,
+            "conversation.item.input_audio_transcription.completed": self._handle_input_audio_transcription_completed,
+            "response.done": self._handle_response_done,
+        }
 
     def on(self, event_name, handler):
-        self.event_handlers[event_name].append(handler)
+        self.event_handlers[event_name] = (handler, inspect.iscoroutinefunction(handler))
+
+    def set_handlers(self, handlers):
+        """Registers the handlers for several events at once, given as a dict of event name to handler.
+        A handler replaces any handler registered earlier for the same event."""
+        for event_name, handler in handlers.items():
+            self.on(event_name, handler)
 
     def dispatch(self, event_name, event):
-        """Dispatches an event to all registered handlers for the given event name.
+        """Dispatches an event to the handler registered for the given event name.
         In this case, this dispatcher is used to notify the Chainlit UI of events it should know of
         to take actions in the UI"""
-        for handler in self.event_handlers[event_name]:
-            if inspect.iscoroutinefunction(handler):
-                asyncio.create_task(handler(event))
-            else:
-                handler(event)
+        entry = self.event_handlers.get(event_name)
+        if entry is None:
+            return
+        handler, is_coroutine = entry
+        if is_coroutine:
+            asyncio.create_task(handler(event))
+        else:
+            handler(event)
 
     def is_connected(self):
-        return self.ws is not None
+        return self.connected
 
     def log(self, *args):
-        logger.debug(f"[Websocket/{datetime.datetime.utcnow().isoformat()}]", *args)
+        # the timestamp is only formatted when debug logging is enabled. The arguments are joined into
+        # the message, as logging would otherwise treat them as %-format arguments of the prefix
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "[Websocket/%s] %s",
+                datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                " ".join(str(arg) for arg in args),
+            )
 
     def get_azure_token(self) -> str:
-        """Get Azure access token using DefaultAzureCredential."""
+        """Get Azure access token using DefaultAzureCredential. A cached token is reused until it is about to expire."""
         try:
-            credential = DefaultAzureCredential()
-            scopes = "https://ai.azure.com/.default"
-            token = credential.get_token(scopes)
-            return token.token
+            return get_access_token()
         except Exception as e:
             logger.error(f"Failed to get Azure token: {e}")
             raise
@@ -227,34 +261,44 @@ class VoiceLiveModelClient:
         - Handle connection timeouts and retries
         - Monitor connection health for production deployments
         """
-        if self.is_connected():
-            # raise Exception("Already connected")
-            self.log("Already connected")  # Get access token
-
-        access_token = self.get_azure_token()
-        # Build WebSocket URL and headers
-        ws_url = self.get_websocket_url(access_token)
-        self.ws = await websockets.connect(
-            ws_url,
-            additional_headers={
-                "Authorization": f"Bearer {self.get_azure_token()}",
-                "x-ms-client-request-id": str(uuid.uuid4()),
-            },
-        )
-        print(f"Connected to Azure Voice Live API....")
-        asyncio.create_task(self.receive())
+        # connected is only set once the handshake is done, so overlapping calls (the preconnect and
+        # the mic being activated) are serialized, and the later one finds the connection established
+        async with self._connect_lock:
+            if self.is_connected():
+                # raise Exception("Already connected")
+                # reconnecting would open a second websocket and receive loop, duplicating every event
+                self.log("Already connected")
+                return
+
+            # Get access token
+            access_token = self.get_azure_token()
+            # Build WebSocket URL and headers
+            ws_url = self.get_websocket_url(access_token)
+            self.ws = await websockets.connect(
+                ws_url,
+                additional_headers={
+                    "Authorization": f"Bearer {access_token}",
+                    "x-ms-client-request-id": str(uuid.uuid4()),
+                },
+                ping_interval=KEEPALIVE_PING_INTERVAL,
+                ping_timeout=KEEPALIVE_PING_TIMEOUT,
+            )
+            self.connected = True
+            logger.info("Connected to Azure Voice Live API....")
+            asyncio.create_task(self.receive())
 
-        await self.update_session()
+            await self.update_session()
 
     async def disconnect(self):
         """Disconnects the client from the WS Connection to the Voice Live API."""
+        self.connected = False
         if self.ws:
             await self.ws.close()
             self.ws = None
-            self.log(f"Disconnected from the Voice Live API")
+            self.log("Disconnected from the Voice Live API")
 
     def _generate_id(self, prefix):
-        return f"{prefix}{int(datetime.datetime.utcnow().timestamp() * 1000)}"
+        return new_event_id(prefix)
 
     async def send(self, event_name, data=None):
         """
@@ -266,7 +310,8 @@ class VoiceLiveModelClient:
         if not isinstance(data, dict):
             raise Exception("data must be a dictionary")
         event = {"event_id": self._generate_id("evt_"), "type": event_name, **data}
-        await self.ws.send(json.dumps(event))
+        # orjson returns bytes; the Voice Live API expects text frames, hence the decode
+        await self.ws.send(orjson.dumps(event).decode())
 
     async def send_user_message_content(self, content=[]):
         """
@@ -299,7 +344,7 @@ class VoiceLiveModelClient:
         """
         if self.is_connected():
             await self.send("session.update", {"session": self.session_config})
-            print("session updated...")
+            logger.debug("session updated...")
 
     async def receive(self):
         """
@@ -333,120 +378,151 @@ class VoiceLiveModelClient:
         - Log important events for debugging and monitoring
         - Validate function parameters before execution
         """
+        ws = self.ws
+        try:
+            await self._receive_events()
+        except websockets.ConnectionClosed as e:
+            logger.warning("Connection to the Voice Live API closed: %s", e)
+        except Exception:
+            logger.exception("Error receiving events from the Voice Live API")
+        finally:
+            # the server may close the connection on its own; stop reporting it as connected,
+            # unless the client has meanwhile moved on to a new connection. disconnect() clears
+            # the flag first, so a connection still flagged as connected was lost unexpectedly
+            if self.ws is ws and self.connected:
+                self.connected = False
+                self.dispatch("connection.lost", {"type": "connection_lost"})
+
+    async def _receive_events(self):
+        # the handler for each event type is looked up in a table built once per client,
+        # rather than comparing the event type against every branch in turn
+        server_event_handlers = self.server_event_handlers
         async for message in self.ws:
-            event = json.loads(message)
+            # the audio deltas are by far the most frequent and largest events; their audio is taken
+            # straight from the message, instead of parsing the JSON around it
+            delta = peek_audio_delta(message)
+            if delta is not None:
+                self._relay_response_audio(delta)
+                continue
+            event = orjson.loads(message)
             # print("event_type", event["type"])
-            if event["type"] == "error":
-                # print("Some error !!", message)
-                pass
-            if event["type"] == "response.audio.delta":
-                # response audio delta events received from server that need to be relayed
-                # to the UI for playback
-                delta = event["delta"]
-                array_buffer = base64_to_array_buffer(delta)
-                append_values = array_buffer.tobytes()
-                _event = {"audio": append_values}
-                # print(f"🎵 Audio chunk received: {len(append_values)} bytes")
-                # send event to chainlit UI to play this audio
-                self.dispatch("conversation.updated", _event)
-            elif event["type"] == "response.audio.done":
-                # server has finished sending back the audio response to the user query
-                # let the chainlit UI know that the response audio has been completely received
-                self.dispatch("conversation.updated", event)
-            elif event["type"] == "input_audio_buffer.committed":
-                # user has stopped speaking. The audio delta input from the user captured till now should now be processed by the server.
-                # Hence we need to send a 'response.create' event to signal the server to respond
-                await self.send("response.create", {"response": self.response_config})
-            elif event["type"] == "input_audio_buffer.speech_started":
-                # Debounce speech start to avoid treating brief coughs as interruptions
-                print("conversation interrupted through new audio input .......")
-                self._speech_active = True
-                self._cancel_pending_interrupt()
-                self._pending_interrupt_task = asyncio.create_task(
-                    self._debounced_interrupt()
+            # events without a handler, errors among them, are ignored
+            handler = server_event_handlers.get(event["type"])
+            if handler is not None:
+                await handler(event)
+
+    async def _handle_response_audio_delta(self, event):
+        # response audio delta events received from server that need to be relayed
+        # to the UI for playback
+        self._relay_response_audio(event["delta"])
+
+    def _relay_response_audio(self, delta):
+        # decoded straight into the bytes handed to the UI, without an intermediate copy
+        append_values = base64_to_bytes(delta)
+        _event = {"audio": append_values}
+        # print(f"🎵 Audio chunk received: {len(append_values)} bytes")
+        # send event to chainlit UI to play this audio
+        self.dispatch("conversation.updated", _event)
+
+    async def _handle_response_audio_done(self, event):
+        # server has finished sending back the audio response to the user query
+        # let the chainlit UI know that the response audio has been completely received
+        self.dispatch("conversation.updated", event)
+
+    async def _handle_input_audio_buffer_committed(self, event):
+        # user has stopped speaking. The audio delta input from the user captured till now should now be processed by the server.
+        # Hence we need to send a 'response.create' event to signal the server to respond
+        await self.send("response.create", {"response": self.response_config})
+
+    async def _handle_speech_started(self, event):
+        # Debounce speech start to avoid treating brief coughs as interruptions
+        logger.debug("conversation interrupted through new audio input .......")
+        self._speech_active = True
+        self._cancel_pending_interrupt()
+        self._pending_interrupt_task = asyncio.create_task(
+            self._debounced_interrupt()
+        )
+
+    async def _handle_speech_stopped(self, event):
+        # User stopped speaking - cancel pending interrupts for short noises
+        self._speech_active = False
+        self._cancel_pending_interrupt()
+
+    async def _handle_response_audio_transcript_delta(self, event):
+        # this event is received when the transcript of the server's audio response to the user has started to come in.
+        # send this to the UI to display the transcript in the chat window, even as the audio of the response gets played
+        delta = event["delta"]
+        item_id = event["item_id"]
+        _event = {"transcript": delta, "item_id": item_id}
+        # signal the UI to display the transcript of the response audio in the chat window
+        self.dispatch("conversation.text.delta", _event)
+
+    async def _handle_input_audio_transcription_completed(self, event):
+        # this event is received when the transcript of the user's query (i.e. input audio) has been completed.
+        # Since this happens asynchronous to the respond audio transcription, the sequence of the two in the chat window
+        # would not necessarily be correct all the time
+        user_query_transcript = event["transcript"]
+        _event = {"transcript": user_query_transcript}
+        self.dispatch("conversation.input.text.done", _event)
+
+    async def _handle_response_done(self, event):
+        # when a user request entails a function call, response.done does not return an audio
+        # It instead returns the functions that match the intent, along with the arguments to invoke it
+        # checking for function call hints in the response
+        # the event is only formatted when debug logging is enabled
+        logger.debug("response done received...%s", event)
+        # let the UI show whatever is left of the response transcript
+        self.dispatch("conversation.response.done", event)
+        try:
+            _status = event.get("response", {}).get("status", None)
+            if "completed" == _status:
+                output_type = (
+                    event.get("response", {})
+                    .get("output", [{}])[0]
+                    .get("type", None)
                 )
-            elif event["type"] == "input_audio_buffer.speech_stopped":
-                # User stopped speaking - cancel pending interrupts for short noises
-                self._speech_active = False
-                self._cancel_pending_interrupt()
-                _speech_event = {"type": "user_speech_stopped"}
-                # self.dispatch("user.speech.stopped", _speech_event)
-            elif event["type"] == "response.audio_transcript.delta":
-                # this event is received when the transcript of the server's audio response to the user has started to come in.
-                # send this to the UI to display the transcript in the chat window, even as the audio of the response gets played
-                delta = event["delta"]
-                item_id = event["item_id"]
-                _event = {"transcript": delta, "item_id": item_id}
-                # signal the UI to display the transcript of the response audio in the chat window
-                self.dispatch("conversation.text.delta", _event)
-            elif (
-                event["type"] == "conversation.item.input_audio_transcription.completed"
-            ):
-                # this event is received when the transcript of the user's query (i.e. input audio) has been completed.
-                # Since this happens asynchronous to the respond audio transcription, the sequence of the two in the chat window
-                # would not necessarily be correct all the time
-                user_query_transcript = event["transcript"]
-                _event = {"transcript": user_query_transcript}
-                self.dispatch("conversation.input.text.done", _event)
-            elif event["type"] == "response.done":
-                # when a user request entails a function call, response.done does not return an audio
-                # It instead returns the functions that match the intent, along with the arguments to invoke it
-                # checking for function call hints in the response
-                print(f"response done received...{event}")
-                try:
-                    _status = event.get("response", {}).get("status", None)
-                    if "completed" == _status:
-                        output_type = (
-                            event.get("response", {})
-                            .get("output", [{}])[0]
-                            .get("type", None)
-                        )
-                        if "function_call" == output_type:
-                            function_name = (
-                                event.get("response", {})
-                                .get("output", [{}])[0]
-                                .get("name", None)
-                            )
-                            arguments = json.loads(
-                                event.get("response", {})
-                                .get("output", [{}])[0]
-                                .get("arguments", None)
-                            )
-                            tool_call_id = (
-                                event.get("response", {})
-                                .get("output", [{}])[0]
-                                .get("call_id", None)
-                            )
-
-                            function_to_call = available_functions[function_name]
-                            # invoke the function with the arguments and get the response
-                            response = function_to_call(**arguments)
-                            print(
-                                f"called function {function_name}, and the response is:",
-                                response,
-                            )
-                            # send the function call response to the server(model)
-                            await self.send(
-                                "conversation.item.create",
-                                {
-                                    "item": {
-                                        "type": "function_call_output",
-                                        "call_id": tool_call_id,
-                                        "output": json.dumps(response),
-                                    }
-                                },
-                            )
-                            # signal the model(server) to generate a response based on the function call output sent to it
-                            await self.send(
-                                "response.create", {"response": self.response_config}
-                            )
-                except Exception as e:
-                    print("Error in processing function call:", e)
-                    print(traceback.format_exc())
-                    pass
-            else:
-                # print("Unknown event type:", event.get("type"))
-                pass
+                if "function_call" == output_type:
+                    function_name = (
+                        event.get("response", {})
+                        .get("output", [{}])[0]
+                        .get("name", None)
+                    )
+                    arguments = orjson.loads(
+                        event.get("response", {})
+                        .get("output", [{}])[0]
+                        .get("arguments", None)
+                    )
+                    tool_call_id = (
+                        event.get("response", {})
+                        .get("output", [{}])[0]
+                        .get("call_id", None)
+                    )
+
+                    function_to_call = available_functions[function_name]
+                    # invoke the function with the arguments and get the response
+                    response = function_to_call(**arguments)
+                    logger.info(
+                        "called function %s, and the response is: %s",
+                        function_name,
+                        response,
+                    )
+                    # send the function call response to the server(model)
+                    await self.send(
+                        "conversation.item.create",
+                        {
+                            "item": {
+                                "type": "function_call_output",
+                                "call_id": tool_call_id,
+                                "output": orjson.dumps(response).decode(),
+                            }
+                        },
+                    )
+                    # signal the model(server) to generate a response based on the function call output sent to it
+                    await self.send(
+                        "response.create", {"response": self.response_config}
+                    )
+        except Exception:
+            logger.exception("Error in processing function call")
 
     async def close(self):
         await self.ws.close()
@@ -475,14 +551,19 @@ class VoiceLiveModelClient:
 
         Note that the server will not start responding just because we sent this audio buffer
         It will do so only when it receives an event 'response.create' from the client
+
+        The audio can be passed as bytes, bytearray or memoryview; it is base64 encoded without being copied first.
         """
         # Check if the array buffer is not empty and send the audio data to the input buffer
         if len(array_buffer) > 0:
-            await self.send(
-                "input_audio_buffer.append",
-                {
-                    "audio": array_buffer_to_base64(np.array(array_buffer)),
-                },
+            if not self.is_connected():
+                raise Exception("Voice Live API is not connected")
+            # the append event has a fixed shape, and base64 needs no escaping in JSON, hence the event is
+            # put together as a string rather than serializing a dict that carries the whole audio payload
+            audio = array_buffer_to_base64(array_buffer)
+            event_id = self._generate_id("evt_")
+            await self.ws.send(
+                f'{{"event_id":"{event_id}","type":"input_audio_buffer.append","audio":"{audio}"}}'
             )
 
     async def clear_input_audio_buffer(self):
@@ -492,4 +573,4 @@ class VoiceLiveModelClient:
         """
         if self.is_connected():
             await self.send("input_audio_buffer.clear")
-            print("Input audio buffer cleared")
+            logger.debug("Input audio buffer cleared")